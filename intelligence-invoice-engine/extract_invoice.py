@@ -1,14 +1,45 @@
 # extractor.py
-import pandas as pd
 import re
 import logging
 import json
+import os
+from functools import lru_cache
+from datetime import date, datetime
 from pydantic import BaseModel
-from typing import Dict, Any
+from python_calamine import CalamineSheet, CalamineWorkbook
+from typing import Dict, Any, BinaryIO, List, Union
 from io import BytesIO
 
 logger = logging.getLogger(__name__)
 
+# Patterns used while scanning cells, compiled once at import
+_INV_LABEL_RE = re.compile(r"invoice\s*(?:no|#|number)", re.IGNORECASE)
+_INV_TOKEN_RE = re.compile(r"([A-Z0-9\-_/]+)", re.IGNORECASE)
+_AMOUNT_COMMA_DEC_RE = re.compile(r"[\d,]+\.\d{1,2}")
+_AMOUNT_COMMA_RE = re.compile(r"[\d,]+")
+_AMOUNT_FULL_RE = re.compile(r"^[\d,]+\.\d{1,2}$")
+
+# Fields detected from the sheet; scanning stops once all of them are filled
+_FIELDS = ("invoice_number", "vendor", "vendor_code", "service", "date", "total_amount")
+
+# Invoice header fields sit at the top of the sheet, so only this many rows
+# are scanned for fields up front; the rest are scanned only when fields are missing
+_HEADER_ROWS = 50
+
+# Header keywords per field. Matched as substrings so joined headers such as
+# "InvoiceNumber" or "Total_Amount" still classify
+_INVOICE_KEYWORDS = ("invoice",)
+_NUMBER_KEYWORDS = ("number", "no", "#")
+_VENDOR_KEYWORDS = ("vendor",)
+_SUPPLIER_KEYWORDS = ("supplier", "from")
+_CODE_KEYWORDS = ("code",)
+_SERVICE_KEYWORDS = ("service", "description")
+_DATE_KEYWORDS = ("date",)
+_AMOUNT_KEYWORDS = ("total", "amount")
+
+# A workbook given as a filesystem path or an open binary file
+ExcelSource = Union[str, os.PathLike, BinaryIO]
+
 class InvoiceData(BaseModel):
     invoice_number: str | None = None
     vendor: str | None = None
@@ -19,13 +50,66 @@ class InvoiceData(BaseModel):
     raw_text: str | None = None
 
 
-def extract_invoice_from_excel_rows(xls_bytes: bytes) -> Dict[str, Any]:
+def _has_keyword(col_lower: str, keywords: tuple) -> bool:
+    return any(keyword in col_lower for keyword in keywords)
+
+
+@lru_cache(maxsize=1024)
+def _classify_header_text(col_lower: str) -> Dict[str, bool]:
+    has_vendor = _has_keyword(col_lower, _VENDOR_KEYWORDS)
+    has_code = _has_keyword(col_lower, _CODE_KEYWORDS)
+    return {
+        "invoice_number": _has_keyword(col_lower, _INVOICE_KEYWORDS) and _has_keyword(col_lower, _NUMBER_KEYWORDS),
+        "vendor": (has_vendor and not has_code) or _has_keyword(col_lower, _SUPPLIER_KEYWORDS),
+        "vendor_code": has_vendor and has_code,
+        "code": has_code,
+        "service": _has_keyword(col_lower, _SERVICE_KEYWORDS),
+        "date": _has_keyword(col_lower, _DATE_KEYWORDS),
+        "total_amount": _has_keyword(col_lower, _AMOUNT_KEYWORDS),
+    }
+
+
+def _classify_header(col_name: Any) -> Dict[str, bool]:
     """
-    Reads Excel file row by row and extracts invoice fields.
+    Works out which invoice fields a column header can hold.
+    Results are cached, since the same headers recur across invoices.
+    """
+    return _classify_header_text(str(col_name).lower())
+
+
+def _cell_to_str(value: Any) -> str:
+    """
+    Renders a cell the same way pandas' read_excel(dtype=str) does.
+    """
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return str(datetime(value.year, value.month, value.day))
+    return str(value)
+
+
+def _read_rows(sheet: CalamineSheet) -> List[List[str]]:
+    """
+    Reads sheet rows (header row first) as lists of strings, blank cells as "".
+    Leading blank rows are kept, as pandas did, so row 1 is always the header row.
+    """
+    rows = sheet.to_python(skip_empty_area=False)
+    return [[_cell_to_str(cell) for cell in row] for row in rows]
+
+
+def _rows_to_text(rows: List[List[str]]) -> str:
+    """
+    Joins the non-blank cells of each row with spaces, one line per row.
+    """
+    return "".join(" ".join(cell for cell in row if cell.strip()) + "\n" for row in rows)
+
+
+def _extract_fields(rows: List[List[str]]) -> Dict[str, Any]:
+    """
+    Scans the rows of a sheet and extracts invoice fields (raw_text is left to the caller).
+    The first row holds the column headers.
     """
-    excel_file = BytesIO(xls_bytes)
-    df = pd.read_excel(excel_file, sheet_name=0, dtype=str)
-    df = df.fillna("")
+    header_row, data_rows = (rows[0], rows[1:]) if rows else ([], [])
     
     invoice_data = {
         "invoice_number": None,
@@ -34,85 +118,114 @@ def extract_invoice_from_excel_rows(xls_bytes: bytes) -> Dict[str, Any]:
         "service": None,
         "date": None,
         "total_amount": None,
-        "raw_text": ""
+        "raw_text": None
     }
     
-    # Read row by row
-    for idx, row in df.iterrows():
-        row_text = " ".join(str(cell) for cell in row.values if str(cell).strip())
-        invoice_data["raw_text"] += row_text + "\n"
+    # Column headers are the same for every row, so classify them once
+    headers = [_classify_header(col_name) for col_name in header_row]
+    
+    # Read row by row until every field has been found
+    for row in data_rows:
+        if all(invoice_data[field] for field in _FIELDS):
+            break
         
         # Check each cell for invoice fields
-        for col_name, cell_value in row.items():
-            col_lower = str(col_name).lower()
-            val_lower = str(cell_value).lower()
+        for header, cell_value in zip(headers, row):
+            # Cells are already strings; strip once and only lowercase on demand
+            cell_str = cell_value.strip()
             
             # Invoice Number
             if not invoice_data["invoice_number"]:
-                if "invoice" in col_lower and ("number" in col_lower or "no" in col_lower or "#" in col_lower):
-                    invoice_data["invoice_number"] = str(cell_value).strip()
-                elif re.search(r"invoice\s*(?:no|#|number)", val_lower):
-                    match = re.search(r"([A-Z0-9\-\_\/]+)", str(cell_value), re.IGNORECASE)
+                if header["invoice_number"]:
+                    invoice_data["invoice_number"] = cell_str
+                elif _INV_LABEL_RE.search(cell_str):
+                    match = _INV_TOKEN_RE.search(cell_str)
                     if match:
                         invoice_data["invoice_number"] = match.group(1).strip()
             
             # Vendor
             if not invoice_data["vendor"]:
-                if "vendor" in col_lower and "code" not in col_lower:
-                    invoice_data["vendor"] = str(cell_value).strip()
-                elif "supplier" in col_lower or "from" in col_lower:
-                    invoice_data["vendor"] = str(cell_value).strip()
+                if header["vendor"]:
+                    invoice_data["vendor"] = cell_str
             
             # Vendor Code
             if not invoice_data["vendor_code"]:
-                if "vendor" in col_lower and "code" in col_lower:
-                    invoice_data["vendor_code"] = str(cell_value).strip()
-                elif "code" in col_lower and "vendor" in val_lower:
-                    invoice_data["vendor_code"] = str(cell_value).strip()
+                if header["vendor_code"]:
+                    invoice_data["vendor_code"] = cell_str
+                elif header["code"] and "vendor" in cell_str.lower():
+                    invoice_data["vendor_code"] = cell_str
             
             # Service
             if not invoice_data["service"]:
-                if "service" in col_lower or "description" in col_lower:
-                    invoice_data["service"] = str(cell_value).strip()
+                if header["service"]:
+                    invoice_data["service"] = cell_str
             
             # Date
             if not invoice_data["date"]:
-                if "date" in col_lower:
-                    invoice_data["date"] = str(cell_value).strip()
+                if header["date"]:
+                    invoice_data["date"] = cell_str
             
             # Total Amount
             if not invoice_data["total_amount"]:
-                if "total" in col_lower or "amount" in col_lower:
-                    # Try multiple patterns for amount extraction
-                    cell_str = str(cell_value).strip()
-                    # Pattern 1: Numbers with commas and decimals (1,350.00)
-                    amount_match = re.search(r"[\d,]+\.\d{1,2}", cell_str)
-                    if not amount_match:
-                        # Pattern 2: Just numbers with decimals (1350.00)
-                        amount_match = re.search(r"\d+\.\d{1,2}", cell_str)
-                    if not amount_match:
-                        # Pattern 3: Numbers with commas but no decimals (1,350)
-                        amount_match = re.search(r"[\d,]+", cell_str)
+                if header["total_amount"]:
+                    # Prefer numbers with decimals (1,350.00 or 1350.00),
+                    # then numbers without decimals (1,350)
+                    amount_match = _AMOUNT_COMMA_DEC_RE.search(cell_str) or _AMOUNT_COMMA_RE.search(cell_str)
                     
                     if amount_match:
                         invoice_data["total_amount"] = amount_match.group(0)
                 # Also check if the cell value itself looks like an amount
                 elif not invoice_data["total_amount"]:
-                    cell_str = str(cell_value).strip()
-                    if re.match(r"^[\d,]+\.\d{1,2}$", cell_str) or re.match(r"^\d+\.\d{1,2}$", cell_str):
+                    if _AMOUNT_FULL_RE.match(cell_str):
                         invoice_data["total_amount"] = cell_str
     
     return invoice_data
 
 
+def _extract_from_source(source: ExcelSource) -> Dict[str, Any]:
+    """
+    Fields are looked for in the first rows, and in the whole sheet only when
+    some are missing there. raw_text always covers every row.
+    """
+    if hasattr(source, "seek"):
+        source.seek(0)
+    sheet = CalamineWorkbook.from_object(source).get_sheet_by_index(0)
+    rows = _read_rows(sheet)
+    
+    # Header row plus the first data rows
+    invoice_data = _extract_fields(rows[:_HEADER_ROWS + 1])
+    
+    if len(rows) > _HEADER_ROWS + 1 and not all(invoice_data[field] for field in _FIELDS):
+        logger.info(f"Fields missing in first {_HEADER_ROWS} rows, scanning full sheet")
+        invoice_data = _extract_fields(rows)
+    
+    invoice_data["raw_text"] = _rows_to_text(rows[1:])
+    return invoice_data
+
 
+def extract_invoice_from_excel_rows(xls_bytes: bytes) -> Dict[str, Any]:
+    """
+    Reads Excel file row by row and extracts invoice fields.
+    """
+    return _extract_from_source(BytesIO(xls_bytes))
 
 
-def extract_invoice_from_xls_bytes(xls_bytes: bytes) -> InvoiceData:
-    logger.info("Extracting invoice from Excel file")
-    fields = extract_invoice_from_excel_rows(xls_bytes)
-    
+def _to_invoice_data(fields: Dict[str, Any]) -> InvoiceData:
     # Log extracted data as JSON
     logger.info(f"Extracted invoice data: {json.dumps(fields, indent=2)}")
     
     return InvoiceData(**fields)
+
+
+def extract_invoice_from_xls_bytes(xls_bytes: bytes) -> InvoiceData:
+    logger.info("Extracting invoice from Excel file")
+    return _to_invoice_data(extract_invoice_from_excel_rows(xls_bytes))
+
+
+def extract_invoice_from_excel_path(path_or_fileobj: ExcelSource) -> InvoiceData:
+    """
+    Extracts invoice fields from a workbook on disk or an open binary file
+    (e.g. a spooled upload) without loading it into a bytes object first.
+    """
+    logger.info("Extracting invoice from Excel file")
+    return _to_invoice_data(_extract_from_source(path_or_fileobj))
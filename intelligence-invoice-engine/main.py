@@ -1,5 +1,8 @@
 import os
 import sys
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional
 from pathlib import Path
 import logging
 
@@ -14,13 +17,43 @@ logger.info(f"Added to sys.path: {Path(__file__).parent}")
 from fastapi import FastAPI, UploadFile, File, Request, Query
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from extract_invoice import extract_invoice_from_xls_bytes, InvoiceData
-from workflow import run_workflow
-from rag_engine import RAGEngine
-from kafka_producer import kafka_producer
+from fastapi.middleware.gzip import GZipMiddleware
+from extract_invoice import extract_invoice_from_excel_path, InvoiceData
+from workflow import arun_workflow
+from rag_engine import get_rag_engine
+from kafka_producer import get_kafka_producer
 import traceback
 
-app = FastAPI(title="Invoice AI Processor")
+# Uploads larger than this are rejected before parsing
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+
+
+def _log_kafka_startup(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Kafka producer initialization failed: {future.exception()}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loop = asyncio.get_running_loop()
+
+    # Connect to Kafka in the background: connection retries back off for
+    # tens of seconds and must not hold up worker readiness
+    kafka_startup = loop.run_in_executor(None, get_kafka_producer)
+    kafka_startup.add_done_callback(_log_kafka_startup)
+
+    # Load and warm the embedding model before taking requests
+    await loop.run_in_executor(None, get_rag_engine().warmup)
+
+    logger.info("Application startup complete")
+    yield
+
+    # Flush queued invoice results before the worker exits
+    if kafka_startup.done() and not kafka_startup.cancelled() and kafka_startup.exception() is None:
+        kafka_startup.result().close()
+
+
+app = FastAPI(title="Invoice AI Processor", lifespan=lifespan)
 logger.info("FastAPI app initialized")
 
 # Add CORS middleware for UI integration
@@ -32,6 +65,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger JSON responses (raw_text, invoice listings) on the way out
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     logger.error(f"Global exception: {str(exc)}", exc_info=True)
@@ -40,10 +76,6 @@ async def global_exception_handler(request: Request, exc: Exception):
         content={"error": str(exc), "traceback": traceback.format_exc()}
     )
 
-@app.on_event("startup")
-async def startup_event():
-    logger.info("Application startup complete")
-
 @app.get("/")
 async def root():
     logger.info("Root endpoint called")
@@ -60,19 +92,32 @@ async def test_upload(file: UploadFile = File(...)):
     return {"filename": file.filename, "content_type": file.content_type}
 
 
+def _upload_too_large(file: UploadFile) -> Optional[JSONResponse]:
+    """Reject uploads over MAX_UPLOAD_BYTES"""
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        logger.warning(f"Rejected {file.filename}: {file.size} bytes exceeds {MAX_UPLOAD_BYTES}")
+        return JSONResponse(
+            content={"error": f"File exceeds maximum size of {MAX_UPLOAD_BYTES} bytes"},
+            status_code=413
+        )
+    return None
+
+
 @app.post("/ocr/extract")
 async def extract_invoice(file: UploadFile = File(...)):
     try:
-        logger.info(f"Received file: {file.filename}")
-        
-        content = await file.read()
-        logger.info(f"Read {len(content)} bytes")
+        logger.info(f"Received file: {file.filename} ({file.size} bytes)")
+        too_large = _upload_too_large(file)
+        if too_large:
+            return too_large
 
+        # Parse straight from the spooled upload instead of reading it into memory
         logger.info("Starting invoice extraction")
-        invoice_data = extract_invoice_from_xls_bytes(content)
+        loop = asyncio.get_running_loop()
+        invoice_data = await loop.run_in_executor(None, extract_invoice_from_excel_path, file.file)
         logger.info("Invoice extraction completed")
 
-        return invoice_data.dict()
+        return invoice_data.model_dump(mode="json")
 
     except Exception as e:
         logger.error(f"Error processing invoice: {str(e)}", exc_info=True)
@@ -85,35 +130,17 @@ async def extract_invoice(file: UploadFile = File(...)):
 @app.post("/process-invoice")
 async def process_invoice(file: UploadFile = File(...)):
     try:
-        logger.info(f"Received file: {file.filename}")
-        
-        file_bytes = await file.read()
-        logger.info(f"Read {len(file_bytes)} bytes")
+        logger.info(f"Received file: {file.filename} ({file.size} bytes)")
+        too_large = _upload_too_large(file)
+        if too_large:
+            return too_large
 
         logger.info("Starting complete invoice workflow")
-        result = run_workflow(file_bytes)
+        result = await arun_workflow(file.file)
         logger.info("Workflow completed")
 
         # Convert to JSON-serializable format
-        serializable_result = {
-            "invoice": result.get("invoice", {}),
-            "validation": result.get("validation", {}),
-            "persisted_chunks": result.get("persisted_chunks", 0),
-            "vector_doc_id": result.get("vector_doc_id", ""),
-            "similar_invoices": result.get("similar_invoices", []),
-            "is_duplicate": result.get("is_duplicate", False),
-            "duplicate_details": result.get("duplicate_details"),
-            # Autonomous Decision Making Results
-            "next_action": result.get("next_action", "APPROVE"),
-            "decision_reasoning": result.get("decision_reasoning", ""),
-            "risk_level": result.get("risk_level", "LOW"),
-            "risk_analysis": result.get("risk_analysis", ""),
-            "requires_approval": result.get("requires_approval", False),
-            "escalate_to_human": result.get("escalate_to_human", False),
-            "escalation_reason": result.get("escalation_reason", ""),
-            "priority_level": result.get("priority_level", "NORMAL"),
-            "synthesis": result.get("synthesis", "")
-        }
+        serializable_result = result.to_response()
 
         return serializable_result
 
@@ -132,37 +159,22 @@ async def process_invoice_data(invoice_data: InvoiceData):
         logger.info(f"POST /process-invoice-data - Processing invoice: {invoice_data.invoice_number}")
         
         # Convert InvoiceData to dict for workflow processing
-        invoice_dict = invoice_data.dict()
+        invoice_dict = invoice_data.model_dump()
         
         logger.info("Starting invoice workflow")
-        result = run_workflow(invoice_dict)
+        result = await arun_workflow(invoice_dict)
         logger.info("Workflow completed")
 
         # Prepare response
-        response = {
-            "invoice": result.get("invoice", {}),
-            "validation": result.get("validation", {}),
-            "persisted_chunks": result.get("persisted_chunks", 0),
-            "vector_doc_id": result.get("vector_doc_id", ""),
-            "similar_invoices": result.get("similar_invoices", []),
-            "is_duplicate": result.get("is_duplicate", False),
-            "duplicate_details": result.get("duplicate_details"),
-            "next_action": result.get("next_action", "APPROVE"),
-            "decision_reasoning": result.get("decision_reasoning", ""),
-            "risk_level": result.get("risk_level", "LOW"),
-            "risk_analysis": result.get("risk_analysis", ""),
-            "requires_approval": result.get("requires_approval", False),
-            "escalate_to_human": result.get("escalate_to_human", False),
-            "escalation_reason": result.get("escalation_reason", ""),
-            "priority_level": result.get("priority_level", "NORMAL"),
-            "synthesis": result.get("synthesis", "")
-        }
+        response = result.to_response()
         
         # Send result to Kafka
         try:
-            kafka_success = kafka_producer.send_invoice_result(response)
+            # First use may still be connecting to the broker
+            producer = await asyncio.get_running_loop().run_in_executor(None, get_kafka_producer)
+            kafka_success = producer.send_invoice_result(response)
             if kafka_success:
-                logger.info(f"Invoice result sent to Kafka successfully")
+                logger.info(f"Invoice result queued for Kafka")
                 response["kafka_sent"] = True
             else:
                 logger.warning(f"Failed to send invoice result to Kafka")
@@ -183,14 +195,13 @@ async def process_invoice_data(invoice_data: InvoiceData):
         )
 
 # Vector Database Management Endpoints
-rag_engine = RAGEngine()
 
 @app.get("/vector-db/status")
 async def get_vector_db_status():
     """Get vector database status and statistics"""
     logger.info("GET /vector-db/status - Getting database status")
     try:
-        status = rag_engine.get_database_status()
+        status = get_rag_engine().get_database_status()
         logger.info(f"Database status retrieved: {status.get('total_documents', 0)} documents")
         return status
     except Exception as e:
@@ -213,7 +224,7 @@ async def clear_vector_db(confirm: bool = Query(False)):
             )
         
         logger.info("Clearing vector database...")
-        result = rag_engine.clear_database()
+        result = get_rag_engine().clear_database()
         logger.info(f"Vector database cleared successfully: {result}")
         return result
     except Exception as e:
@@ -228,7 +239,7 @@ async def list_invoices():
     """List all stored invoices with metadata"""
     logger.info("GET /vector-db/invoices - Listing all invoices")
     try:
-        result = rag_engine.list_invoices()
+        result = get_rag_engine().list_invoices()
         invoice_count = result.get('total_invoices', 0)
         logger.info(f"Retrieved {invoice_count} invoices from database")
         return result
@@ -244,7 +255,7 @@ async def delete_invoice(invoice_id: str):
     """Delete specific invoice by ID"""
     logger.info(f"DELETE /vector-db/invoice/{invoice_id} - Deleting specific invoice")
     try:
-        result = rag_engine.delete_invoice(invoice_id)
+        result = get_rag_engine().delete_invoice(invoice_id)
         logger.info(f"Invoice {invoice_id} deleted successfully: {result}")
         return result
     except Exception as e:
@@ -1,158 +1,266 @@
 # nodes.py
+import asyncio
+import json
+import re
 from typing import Dict, Any, List
-from extract_invoice import extract_invoice_from_xls_bytes
+from langchain_core.documents import Document
+from extract_invoice import extract_invoice_from_xls_bytes, extract_invoice_from_excel_path
 from validator import run_all_validations
-from rag_engine import RAGEngine   # <- your merged class (embed + vectorstore + RAG)
+from rag_engine import get_rag_engine, content_hash   # <- your merged class (embed + vectorstore + RAG)
+from persist_batcher import get_persist_batcher
+from pipeline_state import PipelineState
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Create one shared RAGEngine instance (cheap to reuse models/clients)
-rag_engine = RAGEngine()
+# The process-wide RAGEngine (models and clients are loaded once)
+rag_engine = get_rag_engine()
+
+# similar_node and rag_node share one vector search of max(top_k) results
+SIMILAR_TOP_K = 5
+RAG_TOP_K = 3
+
+# Duplicates at least this similar (1 - squared L2 distance; a content-hash
+# match in prefilter_node counts as 1.0) are rejected and escalated by rule
+# instead of asking the LLM
+EXACT_DUPLICATE_SIMILARITY = 0.999
+
+# Length of the content preview in similar_invoices
+_PREVIEW_CHARS = 200
+
+# Invoice fields embedded when there is no raw_text
+_EMBED_FIELDS = ("vendor", "vendor_code", "service", "invoice_number", "total_amount")
+
+# synth_node recommendation text
+_DUP_TMPL = (
+    "⚠️ DUPLICATE DETECTED: This invoice appears to be a duplicate of a previously processed invoice "
+    "(similarity: {score}). Recommendation: REJECT - Do not process for payment to avoid duplicate payment."
+)
+_APPROVE_SUFFIX = " No duplicates detected (highest similarity: {score}). Recommendation: Approve for payment."
+_NO_SIM_SUFFIX = " No similar invoices found. Recommendation: Approve for payment."
+
+def _invoice_text(invoice: Dict[str, Any]) -> str:
+    """Text that is chunked, embedded and searched for an invoice"""
+    return invoice.get("raw_text") or " ".join(v for k in _EMBED_FIELDS if (v := invoice.get(k)))
+
+def _preview(content: str) -> str:
+    return content if len(content) <= _PREVIEW_CHARS else f"{content[:_PREVIEW_CHARS]}..."
 
 # -----------------------
 # OCR Node
 # -----------------------
-def ocr_node(state: Dict[str, Any]) -> Dict[str, Any]:
+async def ocr_node(state: PipelineState) -> PipelineState:
     """
-    Expects: state["file_bytes"]
-    Produces: state["invoice"] (dict with fields + raw_text)
+    Expects: state.file_bytes or state.file_obj (open binary file)
+    Produces: state.invoice (dict with fields + raw_text)
     """
-    file_bytes = state.get("file_bytes")
-    if not file_bytes:
-        raise ValueError("ocr_node requires 'file_bytes' in state")
+    file_obj = state.file_obj
+    file_bytes = state.file_bytes
+    if file_obj is not None:
+        invoice = (await asyncio.to_thread(extract_invoice_from_excel_path, file_obj)).model_dump()
+    elif file_bytes:
+        invoice = (await asyncio.to_thread(extract_invoice_from_xls_bytes, file_bytes)).model_dump()
+    else:
+        raise ValueError("ocr_node requires 'file_bytes' or 'file_obj' in state")
 
-    invoice = extract_invoice_from_xls_bytes(file_bytes).dict()
-    state["invoice"] = invoice
+    state.invoice = invoice
     logger.debug("ocr_node: extracted invoice fields")
     return state
 
 # -----------------------
 # Validation Node
 # -----------------------
-def validate_node(state: Dict[str, Any]) -> Dict[str, Any]:
+async def validate_node(state: PipelineState) -> PipelineState:
     """
-    Expects: state["invoice"]
-    Produces: state["validation"]
+    Expects: state.invoice
+    Produces: state.validation
     """
-    invoice = state.get("invoice", {})
-    validation = run_all_validations(invoice)
-    state["validation"] = validation
+    state.validation = run_all_validations(state.invoice)
     logger.debug("validate_node: validation completed")
     return state
 
+# -----------------------
+# Prefilter Node (metadata-only duplicate check)
+# -----------------------
+async def prefilter_node(state: PipelineState, top_k: int = SIMILAR_TOP_K) -> PipelineState:
+    """
+    Expects: state.invoice
+    Produces: state.is_duplicate, state.duplicate_details, state.similar_invoices
+              when chunks with the same invoice number (and vendor) and the same
+              content hashes are already stored
+    Uses chunk metadata and hashes only, so no embedding or HNSW search is needed.
+    """
+    invoice = state.invoice
+    invoice_num = invoice.get("invoice_number")
+    if not invoice_num:
+        return state
+
+    where = {"invoice_number": invoice_num}
+    vendor = invoice.get("vendor")
+    if vendor:
+        where = {"$and": [where, {"vendor": vendor}]}
+
+    matches = await asyncio.to_thread(rag_engine.find_by_metadata, where, top_k)
+    if not matches:
+        return state
+
+    # Same number and vendor alone may be a corrected re-issue, which
+    # similar_node judges by content: only an exact copy of every chunk
+    # is settled here
+    chunks = await asyncio.to_thread(rag_engine.split_documents, _invoice_text(invoice))
+    hashes = {content_hash(chunk.page_content) for chunk in chunks}
+    stored = await asyncio.to_thread(rag_engine.existing_hashes, list(hashes)) if hashes else set()
+    same = [doc for doc in matches if (doc.metadata or {}).get("hash") in hashes]
+    if not same or not hashes <= stored:
+        logger.info(f"prefilter_node: invoice {invoice_num} already stored with different content")
+        return state
+
+    state.is_duplicate = True
+    state.duplicate_details = {
+        "duplicate_content": same[0].page_content,
+        "similarity_score": 1.0,
+        "metadata": same[0].metadata or {},
+        "matched_on": "content_hash"
+    }
+    state.similar_invoices = [
+        {
+            "content": _preview(doc.page_content),
+            "similarity_score": 1.0,
+            "metadata": doc.metadata or {}
+        }
+        for doc in same
+    ]
+    state.highest_similarity = 1.0
+    logger.info(f"prefilter_node: invoice {invoice_num} already stored with the same content, skipping embedding")
+    return state
+
 # -----------------------
 # Embed Node (split text into chunks)
 # -----------------------
-def embed_node(state: Dict[str, Any]) -> Dict[str, Any]:
+async def embed_node(state: PipelineState) -> PipelineState:
     """
-    Expects: state["invoice"]
-    Produces: state["chunks"] (List[Document]) and state["embedding_text"]
+    Expects: state.invoice
+    Produces: state.chunks (List[Document]), state.embedding_text and state.query_embedding
     """
-    invoice = state.get("invoice", {})
-    text = invoice.get("raw_text") or " ".join(filter(None, [
-        invoice.get("vendor"),
-        invoice.get("vendor_code"),
-        invoice.get("service"),
-        invoice.get("invoice_number"),
-        invoice.get("total_amount")
-    ]))
+    invoice = state.invoice
+    text = _invoice_text(invoice)
     # Save the text we will embed/retrieve on
-    state["embedding_text"] = text
+    state.embedding_text = text
+
+    # Embed the query once; similar_node and rag_node both search with it
+    if text:
+        state.query_embedding = await asyncio.to_thread(rag_engine.embed_query_cached, text)
 
     # Split into chunks (langchain Document objects)
-    chunks = rag_engine.split_documents(text)
-    state["chunks"] = chunks
+    chunks = await asyncio.to_thread(rag_engine.split_documents, text)
+
+    # Tag chunks so prefilter_node can find this invoice again by metadata
+    # (Chroma rejects None metadata values, so only present fields are set)
+    invoice_metadata = {key: invoice[key] for key in ("invoice_number", "vendor") if invoice.get(key)}
+    for chunk in chunks:
+        chunk.metadata.update(invoice_metadata)
+    state.chunks = chunks
     logger.debug(f"embed_node: split into {len(chunks)} chunks")
     return state
 
 # -----------------------
 # Persist Node (embed & persist with dedup)
 # -----------------------
-def persist_node(state: Dict[str, Any]) -> Dict[str, Any]:
+async def persist_node(state: PipelineState) -> PipelineState:
     """
-    Expects: state["chunks"], state["is_duplicate"]
-    Produces: state["vector_doc_id"] (derived from invoice number or hash)
+    Expects: state.chunks, state.is_duplicate
+    Produces: state.vector_doc_id (derived from invoice number or hash)
     Side-effect: upserts embeddings into Chroma (persisted) - only if not duplicate
     """
-    chunks = state.get("chunks", [])
-    if not chunks:
-        logger.warning("persist_node: no chunks found, skipping persist")
-        return state
+    chunks = state.chunks
 
     # Skip persisting if this is a duplicate
-    if state.get("is_duplicate", False):
+    if state.is_duplicate:
         logger.info("persist_node: skipping persist - duplicate detected")
-        state["persisted_chunks"] = 0
+        state.persisted_chunks = 0
+    elif not chunks:
+        logger.warning("persist_node: no chunks found, skipping persist")
+        return state
     else:
-        # embed + store with dedup checks inside RAGEngine
-        inserted = rag_engine.embed_documents(chunks)  # returns number new docs (per your RAGEngine)
-        state["persisted_chunks"] = inserted
+        # embed + store with dedup checks inside RAGEngine, batched with other invoices in flight
+        inserted = await get_persist_batcher(rag_engine).add(chunks)  # returns number of this invoice's new docs
+        state.persisted_chunks = inserted
         logger.debug(f"persist_node: persisted {inserted} new chunks")
 
     # create a doc id for the invoice (use invoice number when available)
-    invoice_num = state.get("invoice", {}).get("invoice_number")
+    invoice_num = state.invoice.get("invoice_number")
     if invoice_num:
-        state["vector_doc_id"] = f"invoice_{invoice_num}"
+        state.vector_doc_id = f"invoice_{invoice_num}"
     else:
         # fall back to a deterministic hash of the text
-        import hashlib
-        h = hashlib.md5(state["embedding_text"].encode("utf-8")).hexdigest()
-        state["vector_doc_id"] = f"invoice_{h}"
+        h = content_hash(state.embedding_text)
+        state.vector_doc_id = f"invoice_{h}"
 
     return state
 
+# -----------------------
+# Shared retrieval (one Chroma query for similarity + RAG)
+# -----------------------
+async def retrieve_shared(state: PipelineState, top_k: int) -> List[tuple]:
+    """
+    Expects: state.embedding_text, optionally state.query_embedding
+    Produces: state.retrieval_results ((Document, distance) pairs), queried once per state
+    """
+    if state.retrieval_results is None:
+        state.retrieval_results = await asyncio.to_thread(
+            rag_engine.retrieve_with_scores, state.embedding_text, top_k, state.query_embedding
+        )
+    return state.retrieval_results
+
 # -----------------------
 # Similarity Node (semantic duplicates / similar docs)
 # -----------------------
-def similar_node(state: Dict[str, Any], top_k: int = 5) -> Dict[str, Any]:
+async def similar_node(state: PipelineState, top_k: int = SIMILAR_TOP_K) -> PipelineState:
     """
-    Expects: state["embedding_text"] OR state["embedding"] (we use text here)
-    Produces: state["similar_invoices"], state["is_duplicate"], state["duplicate_details"]
+    Expects: state.embedding_text, optionally state.query_embedding
+    Produces: state.similar_invoices, state.highest_similarity, state.is_duplicate, state.duplicate_details
     """
-    text = state.get("embedding_text", "")
+    text = state.embedding_text
     if not text:
         logger.warning("similar_node: no embedding_text found, skipping similarity search")
-        state["similar_invoices"] = []
-        state["is_duplicate"] = False
-        state["duplicate_details"] = None
+        state.similar_invoices = []
+        state.highest_similarity = 0
+        state.is_duplicate = False
+        state.duplicate_details = None
         return state
 
     # Get similarity results with scores (ChromaDB returns distance, lower = more similar)
-    similar_results = rag_engine.retrieve_with_scores(text, top_k=top_k)
+    results = await retrieve_shared(state, max(top_k, RAG_TOP_K))
+    similar_results = results[:top_k]
     
-    # Process results for duplicate detection and formatting
-    similar_invoices = []
+    # Duplicate check: the first hit with distance < 0.1. Distances are squared L2
+    # between normalized vectors, 2 * (1 - cosine), so this means cosine > 0.95
     is_duplicate = False
     duplicate_details = None
-    
-    for doc, distance in similar_results:
-        # Convert distance to similarity score (1 - distance, capped at 0-1)
-        similarity_score = max(0, 1 - distance)
-        
-        # Extract invoice info from metadata or content
-        metadata = doc.metadata or {}
-        
-        invoice_info = {
-            "content": doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content,
-            "similarity_score": round(similarity_score, 3),
-            "metadata": metadata
+    duplicate = next(((doc, distance) for doc, distance in similar_results if distance < 0.1), None)
+    if duplicate is not None:
+        doc, distance = duplicate
+        is_duplicate = True
+        duplicate_details = {
+            "duplicate_content": doc.page_content,
+            "similarity_score": round(max(0, 1 - distance), 3),
+            "metadata": doc.metadata or {}
+        }
+
+    # Convert distance to similarity score (1 - distance, capped at 0-1)
+    similar_invoices = [
+        {
+            "content": _preview(doc.page_content),
+            "similarity_score": round(max(0, 1 - distance), 3),
+            "metadata": doc.metadata or {}
         }
-        
-        # Check for duplicates (distance < 0.1 means very similar, similarity > 0.9)
-        if distance < 0.1 and not is_duplicate:
-            is_duplicate = True
-            duplicate_details = {
-                "duplicate_content": doc.page_content,
-                "similarity_score": round(similarity_score, 3),
-                "metadata": metadata
-            }
-        
-        similar_invoices.append(invoice_info)
+        for doc, distance in similar_results
+    ]
     
-    state["similar_invoices"] = similar_invoices
-    state["is_duplicate"] = is_duplicate
-    state["duplicate_details"] = duplicate_details
+    state.similar_invoices = similar_invoices
+    state.highest_similarity = max((inv["similarity_score"] for inv in similar_invoices), default=0)
+    state.is_duplicate = is_duplicate
+    state.duplicate_details = duplicate_details
     
     logger.debug(f"similar_node: found {len(similar_invoices)} similar docs, duplicate: {is_duplicate}")
     return state
@@ -160,44 +268,55 @@ def similar_node(state: Dict[str, Any], top_k: int = 5) -> Dict[str, Any]:
 # -----------------------
 # RAG Node (build retrieval context)
 # -----------------------
-def rag_node(state: Dict[str, Any], top_k: int = 5) -> Dict[str, Any]:
+async def rag_node(state: PipelineState, top_k: int = RAG_TOP_K) -> PipelineState:
     """
-    Expects: state["embedding_text"]
-    Produces: state["rag"] (retrieved hits / context)
+    Expects: state.embedding_text, state.chunks, state.retrieval_results (from similar_node)
+    Produces: state.rag (retrieved hits / context)
     """
-    text = state.get("embedding_text", "")
+    text = state.embedding_text
     if not text:
         logger.warning("rag_node: no embedding_text found, skipping RAG")
-        state["rag"] = {"hits": []}
+        state.rag = {"hits": []}
         return state
 
-    rag_context = rag_engine.build_rag_context(text, top_k=top_k)
-    state["rag"] = rag_context
-    logger.debug(f"rag_node: retrieved {len(rag_context.get('hits', []))} hits")
+    results = await retrieve_shared(state, max(SIMILAR_TOP_K, top_k))
+    docs = [doc for doc, _ in results]
+
+    # The shared search can run before this invoice's chunks are stored; any
+    # chunk it did not return is new and would be a fresh query's nearest hit.
+    # Deciding this without persisted_chunks lets RAG overlap with persist_node
+    retrieved = {d.page_content for d in docs}
+    docs = [c for c in state.chunks if c.page_content not in retrieved] + docs
+
+    rag_context = {
+        "hits": [{"content": d.page_content, "metadata": d.metadata} for d in docs[:top_k]],
+        "query": text
+    }
+    state.rag = rag_context
+    logger.debug(f"rag_node: retrieved {len(rag_context['hits'])} hits")
     return state
 
 # -----------------------
 # Synthesis Node (LLM explanation)
 # -----------------------
-def synth_node(state: Dict[str, Any]) -> Dict[str, Any]:
+async def synth_node(state: PipelineState) -> PipelineState:
     """
-    Expects: state["invoice"], state["validation"], state["rag"], state["is_duplicate"]
-    Produces: state["synthesis"] (text)
+    Expects: state.invoice, state.validation, state.rag, state.is_duplicate
+    Produces: state.synthesis (text)
     """
-    invoice = state.get("invoice", {})
-    validation = state.get("validation", {})
-    rag_hits = state.get("rag", {}).get("hits", [])
-    is_duplicate = state.get("is_duplicate", False)
-    duplicate_details = state.get("duplicate_details")
-    similar_invoices = state.get("similar_invoices", [])
+    invoice = state.invoice
+    validation = state.validation
+    rag_hits = state.rag.get("hits", [])
+    is_duplicate = state.is_duplicate
+    duplicate_details = state.duplicate_details
 
     # Check for duplicate first
     if is_duplicate and duplicate_details:
         similarity_score = duplicate_details.get("similarity_score", 0)
-        answer = f"⚠️ DUPLICATE DETECTED: This invoice appears to be a duplicate of a previously processed invoice (similarity: {similarity_score}). Recommendation: REJECT - Do not process for payment to avoid duplicate payment."
+        answer = _DUP_TMPL.format(score=similarity_score)
     else:
         # Build a short question/prompt automatically
-        highest_similarity = max([inv.get("similarity_score", 0) for inv in similar_invoices], default=0)
+        highest_similarity = state.highest_similarity
         question = (
             f"Explain validation results for invoice {invoice.get('invoice_number')} "
             f"and recommend next steps. Include any evidence from retrieved documents. "
@@ -206,264 +325,216 @@ def synth_node(state: Dict[str, Any]) -> Dict[str, Any]:
 
         try:
             # Convert rag_hits to Documents for generate_answer
-            from langchain_core.documents import Document
             docs = [Document(page_content=hit["content"], metadata=hit.get("metadata", {})) for hit in rag_hits]
-            answer = rag_engine.generate_answer(question, docs)
+            answer = await rag_engine.agenerate_answer(question, docs)
             
             # Add duplicate check info to the answer
             if highest_similarity > 0:
-                answer += f" No duplicates detected (highest similarity: {highest_similarity}). Recommendation: Approve for payment."
+                suffix = _APPROVE_SUFFIX.format(score=highest_similarity)
             else:
-                answer += " No similar invoices found. Recommendation: Approve for payment."
+                suffix = _NO_SIM_SUFFIX
+            answer = "".join((answer, suffix))
                 
         except Exception as e:
             logger.exception("synth_node: generate_answer failed, falling back to plain summary")
             # fallback synthesis
             answer = f"Validation overall_ok={validation.get('overall_ok')}. Issues: {validation.get('issues')}"
 
-    state["synthesis"] = answer
+    state.synthesis = answer
     logger.debug("synth_node: synthesis completed")
     return state
 
 # -----------------------
-# AUTONOMOUS DECISION NODES
+# AUTONOMOUS DECISION NODE
 # -----------------------
 
-def decision_node(state: Dict[str, Any]) -> Dict[str, Any]:
+# The first {...} block in the LLM reply (models often wrap JSON in prose)
+_JSON_BLOCK_RE = re.compile(r"\{.*\}", re.S)
+
+# "KEY: value | KEY: value" replies, for models that ignore the JSON format
+_ACTION_RE = re.compile(r"ACTION:\s*(\w+)(?:\s*\|\s*REASON:\s*([^|\n]+))?", re.I)
+_RISK_RE = re.compile(r"RISK(?:_LEVEL)?:\s*(\w+)(?:\s*\|\s*ANALYSIS:\s*([^|\n]+))?", re.I)
+_ESC_RE = re.compile(r"ESCALATE:\s*(\w+)(?:\s*\|\s*PRIORITY:\s*(\w+))?(?:\s*\|\s*REASON:\s*([^|\n]+))?", re.I)
+
+_VALID_ACTIONS = frozenset({"APPROVE", "MANUAL_REVIEW", "REJECT", "REQUEST_INFO"})
+_VALID_RISK_LEVELS = frozenset({"LOW", "MEDIUM", "HIGH"})
+_VALID_PRIORITIES = frozenset({"URGENT", "HIGH", "NORMAL", "LOW"})
+
+# Characters dropped from total_amount before float()
+_AMOUNT_STRIP = str.maketrans("", "", ",$ ")
+
+
+def _parse_labelled_decision(response: str) -> Dict[str, Any]:
+    """Reads a "KEY: value | ..." reply into the same keys as the JSON format"""
+    action = _ACTION_RE.search(response)
+    if not action:
+        raise ValueError("no JSON object or ACTION label in LLM response")
+    decision: Dict[str, Any] = {"next_action": action.group(1), "decision_reasoning": action.group(2)}
+
+    risk = _RISK_RE.search(response)
+    if risk:
+        decision["risk_level"] = risk.group(1)
+        decision["risk_analysis"] = risk.group(2)
+
+    escalation = _ESC_RE.search(response)
+    if escalation:
+        decision["escalate_to_human"] = escalation.group(1)
+        decision["priority_level"] = escalation.group(2)
+        decision["escalation_reason"] = escalation.group(3)
+
+    return {key: value.strip() if isinstance(value, str) else value for key, value in decision.items()}
+
+
+def _fallback_decision(state: PipelineState) -> None:
+    """Rule-based next action when the LLM is unavailable"""
+    if state.is_duplicate:
+        state.next_action = "REJECT"
+        state.decision_reasoning = "Duplicate invoice detected"
+    elif not state.validation.get("overall_ok", False):
+        state.next_action = "MANUAL_REVIEW"
+        state.decision_reasoning = "Validation issues found"
+    else:
+        state.next_action = "APPROVE"
+        state.decision_reasoning = "All checks passed"
+
+
+def _fallback_risk(state: PipelineState, amount: float) -> None:
+    """Rule-based risk assessment when the LLM is unavailable"""
+    validation = state.validation
+    if amount > 10000 or len(validation.get("issues", [])) > 0:
+        state.risk_level = "HIGH"
+        state.requires_approval = True
+    elif amount > 1000 or len(state.similar_invoices) == 0:
+        state.risk_level = "MEDIUM"
+        state.requires_approval = True
+    else:
+        state.risk_level = "LOW"
+        state.requires_approval = False
+
+    state.risk_analysis = f"Fallback assessment: Amount=${amount:,.2f}, Issues={len(validation.get('issues', []))}"
+
+
+def _fallback_escalation(state: PipelineState) -> None:
+    """Rule-based escalation from the decision and risk results already in state"""
+    validation = state.validation
+    risk_level = state.risk_level
+    next_action = state.next_action
+    should_escalate = (
+        risk_level == "HIGH" or
+        next_action in ["REJECT", "MANUAL_REVIEW"] or
+        state.is_duplicate or
+        len(validation.get("issues", [])) > 2
+    )
+
+    state.escalate_to_human = should_escalate
+    state.escalation_reason = f"Fallback: Risk={risk_level}, Action={next_action}, Issues={len(validation.get('issues', []))}"
+    state.priority_level = "HIGH" if should_escalate else "NORMAL"
+
+
+async def combined_decision_node(state: PipelineState) -> PipelineState:
     """
-    LLM analyzes invoice and decides next processing action
-    Produces: state["next_action"], state["decision_reasoning"]
+    One LLM call decides the next action, assesses risk and decides escalation
+    Produces: state.next_action, state.decision_reasoning,
+              state.risk_level, state.risk_analysis, state.requires_approval,
+              state.escalate_to_human, state.escalation_reason, state.priority_level
     """
-    invoice = state.get("invoice", {})
-    validation = state.get("validation", {})
-    is_duplicate = state.get("is_duplicate", False)
-    
+    invoice = state.invoice
+    validation = state.validation
+    similar_invoices = state.similar_invoices
+    is_duplicate = state.is_duplicate
+
+    # Extract amount as float for analysis
+    amount_str = invoice.get("total_amount") or "0"
+    try:
+        amount = float(amount_str.translate(_AMOUNT_STRIP) or "0")
+    except (ValueError, AttributeError):
+        amount = 0
+
+    if is_duplicate and state.highest_similarity >= EXACT_DUPLICATE_SIMILARITY:
+        logger.info("combined_decision_node: exact duplicate, deciding without the LLM")
+        _fallback_decision(state)
+        _fallback_risk(state, amount)
+        _fallback_escalation(state)
+        return state
+
     prompt = f"""
-    Analyze this invoice and decide the next action:
-    
+    Analyze this invoice, assess its risk and decide whether it needs a human.
+
     Invoice Details:
     - Number: {invoice.get('invoice_number', 'N/A')}
     - Vendor: {invoice.get('vendor', 'N/A')}
     - Vendor Code: {invoice.get('vendor_code', 'N/A')}
     - Service: {invoice.get('service', 'N/A')}
-    - Amount: {invoice.get('total_amount', 'N/A')}
+    - Amount: ${amount:,.2f}
     - Date: {invoice.get('date', 'N/A')}
-    
+
     Validation Status:
     - Overall OK: {validation.get('overall_ok', False)}
     - Issues: {validation.get('issues', [])}
-    
+
     Duplicate Status: {is_duplicate}
-    
-    Choose ONE action and provide reasoning:
-    1. APPROVE - Process normally (low risk, all validations pass)
-    2. MANUAL_REVIEW - Requires human review (medium risk, some concerns)
-    3. REJECT - Reject immediately (high risk, major issues)
-    4. REQUEST_INFO - Need more information (missing critical data)
-    
-    Format: ACTION: [choice] | REASON: [brief explanation]
-    """
-    
-    try:
-        decision_response = rag_engine.generate_answer(prompt, [])
-        
-        # Parse the response
-        if "ACTION:" in decision_response and "REASON:" in decision_response:
-            parts = decision_response.split("|")
-            action_part = parts[0].replace("ACTION:", "").strip().upper()
-            reason_part = parts[1].replace("REASON:", "").strip() if len(parts) > 1 else "No reason provided"
-        else:
-            # Fallback parsing
-            action_part = "MANUAL_REVIEW"  # Safe default
-            reason_part = decision_response
-        
-        # Validate action
-        valid_actions = ["APPROVE", "MANUAL_REVIEW", "REJECT", "REQUEST_INFO"]
-        if action_part not in valid_actions:
-            action_part = "MANUAL_REVIEW"
-        
-        state["next_action"] = action_part
-        state["decision_reasoning"] = reason_part
-        
-    except Exception as e:
-        logger.exception("decision_node: LLM decision failed, using fallback logic")
-        # Fallback decision logic
-        if is_duplicate:
-            state["next_action"] = "REJECT"
-            state["decision_reasoning"] = "Duplicate invoice detected"
-        elif not validation.get("overall_ok", False):
-            state["next_action"] = "MANUAL_REVIEW"
-            state["decision_reasoning"] = "Validation issues found"
-        else:
-            state["next_action"] = "APPROVE"
-            state["decision_reasoning"] = "All checks passed"
-    
-    logger.debug(f"decision_node: Action={state['next_action']}, Reason={state['decision_reasoning']}")
-    return state
+    Similar invoices in system: {len(similar_invoices)}
 
-def risk_assessment_node(state: Dict[str, Any]) -> Dict[str, Any]:
-    """
-    LLM assesses risk level and determines processing priority
-    Produces: state["risk_level"], state["risk_analysis"], state["requires_approval"]
-    """
-    invoice = state.get("invoice", {})
-    similar_invoices = state.get("similar_invoices", [])
-    validation = state.get("validation", {})
-    
-    # Extract amount as float for analysis
-    amount_str = invoice.get("total_amount", "0")
-    try:
-        amount = float(amount_str.replace(",", "").replace("$", ""))
-    except:
-        amount = 0
-    
-    prompt = f"""
-    Assess the risk level for this invoice processing:
-    
-    Invoice Analysis:
-    - Vendor: {invoice.get('vendor', 'Unknown')}
-    - Vendor Code: {invoice.get('vendor_code', 'Unknown')}
-    - Service: {invoice.get('service', 'Unknown')}
-    - Amount: ${amount:,.2f}
-    - Similar invoices in system: {len(similar_invoices)}
-    - Validation issues: {len(validation.get('issues', []))}
-    
-    Risk Factors to Consider:
-    - High amounts (>$10,000) = higher risk
-    - New/unknown vendors = higher risk
-    - Validation failures = higher risk
-    - No similar invoices = medium risk
-    - Many similar invoices = potential pattern
-    
-    Rate risk as: LOW, MEDIUM, or HIGH
-    Provide reasoning for your assessment.
-    
-    Format: RISK: [level] | ANALYSIS: [detailed reasoning]
-    """
-    
-    try:
-        risk_response = rag_engine.generate_answer(prompt, [])
-        
-        # Parse response
-        if "RISK:" in risk_response and "ANALYSIS:" in risk_response:
-            parts = risk_response.split("|")
-            risk_part = parts[0].replace("RISK:", "").strip().upper()
-            analysis_part = parts[1].replace("ANALYSIS:", "").strip() if len(parts) > 1 else risk_response
-        else:
-            # Fallback parsing
-            if "HIGH" in risk_response.upper():
-                risk_part = "HIGH"
-            elif "MEDIUM" in risk_response.upper():
-                risk_part = "MEDIUM"
-            else:
-                risk_part = "LOW"
-            analysis_part = risk_response
-        
-        # Validate risk level
-        if risk_part not in ["LOW", "MEDIUM", "HIGH"]:
-            risk_part = "MEDIUM"  # Safe default
-        
-        state["risk_level"] = risk_part
-        state["risk_analysis"] = analysis_part
-        state["requires_approval"] = risk_part in ["MEDIUM", "HIGH"]
-        
-    except Exception as e:
-        logger.exception("risk_assessment_node: LLM risk assessment failed, using fallback logic")
-        # Fallback risk assessment
-        if amount > 10000 or len(validation.get("issues", [])) > 0:
-            state["risk_level"] = "HIGH"
-            state["requires_approval"] = True
-        elif amount > 1000 or len(similar_invoices) == 0:
-            state["risk_level"] = "MEDIUM"
-            state["requires_approval"] = True
-        else:
-            state["risk_level"] = "LOW"
-            state["requires_approval"] = False
-        
-        state["risk_analysis"] = f"Fallback assessment: Amount=${amount:,.2f}, Issues={len(validation.get('issues', []))}"
-    
-    logger.debug(f"risk_assessment_node: Risk={state['risk_level']}, Approval Required={state['requires_approval']}")
-    return state
+    1. Next action - choose ONE:
+       APPROVE - Process normally (low risk, all validations pass)
+       MANUAL_REVIEW - Requires human review (medium risk, some concerns)
+       REJECT - Reject immediately (high risk, major issues)
+       REQUEST_INFO - Need more information (missing critical data)
 
-def escalation_decision_node(state: Dict[str, Any]) -> Dict[str, Any]:
-    """
-    LLM decides if human intervention is needed
-    Produces: state["escalate_to_human"], state["escalation_reason"], state["priority_level"]
-    """
-    risk_level = state.get("risk_level", "MEDIUM")
-    validation = state.get("validation", {})
-    is_duplicate = state.get("is_duplicate", False)
-    next_action = state.get("next_action", "APPROVE")
-    invoice = state.get("invoice", {})
-    
-    prompt = f"""
-    Determine if this invoice requires human escalation:
-    
-    Current Status:
-    - Risk Level: {risk_level}
-    - Recommended Action: {next_action}
-    - Validation Issues: {validation.get('issues', [])}
-    - Is Duplicate: {is_duplicate}
-    - Invoice Amount: {invoice.get('total_amount', 'N/A')}
-    - Vendor: {invoice.get('vendor', 'N/A')}
-    - Vendor Code: {invoice.get('vendor_code', 'N/A')}
-    - Service: {invoice.get('service', 'N/A')}
-    
-    Escalation Criteria:
-    - HIGH risk always escalates
-    - REJECT actions need human confirmation
-    - Complex validation issues
-    - Large amounts (>$5,000)
-    - New vendor patterns
-    
-    Also assign priority: URGENT, HIGH, NORMAL, LOW
-    
-    Should this be escalated to a human? Respond YES or NO with reasoning.
-    
-    Format: ESCALATE: [YES/NO] | PRIORITY: [level] | REASON: [explanation]
+    2. Risk level - LOW, MEDIUM or HIGH. Consider:
+       - High amounts (>$10,000) = higher risk
+       - New/unknown vendors = higher risk
+       - Validation failures = higher risk
+       - No similar invoices = medium risk
+       - Many similar invoices = potential pattern
+
+    3. Escalation to a human - true or false, with priority URGENT, HIGH, NORMAL or LOW:
+       - HIGH risk always escalates
+       - REJECT actions need human confirmation
+       - Complex validation issues
+       - Large amounts (>$5,000)
+       - New vendor patterns
+
+    Respond with ONLY a JSON object in this format:
+    {{"next_action": "...", "decision_reasoning": "...", "risk_level": "...", "risk_analysis": "...", "escalate_to_human": true, "priority_level": "...", "escalation_reason": "..."}}
     """
-    
+
     try:
-        escalation_response = rag_engine.generate_answer(prompt, [])
-        
-        # Parse response
-        escalate = "NO"
-        priority = "NORMAL"
-        reason = escalation_response
-        
-        if "ESCALATE:" in escalation_response:
-            parts = escalation_response.split("|")
-            escalate_part = parts[0].replace("ESCALATE:", "").strip().upper()
-            escalate = "YES" if "YES" in escalate_part else "NO"
-            
-            if len(parts) > 1 and "PRIORITY:" in parts[1]:
-                priority_part = parts[1].replace("PRIORITY:", "").strip().upper()
-                if priority_part in ["URGENT", "HIGH", "NORMAL", "LOW"]:
-                    priority = priority_part
-            
-            if len(parts) > 2 and "REASON:" in parts[2]:
-                reason = parts[2].replace("REASON:", "").strip()
-        else:
-            # Simple parsing
-            escalate = "YES" if "YES" in escalation_response.upper() else "NO"
-        
-        state["escalate_to_human"] = escalate == "YES"
-        state["escalation_reason"] = reason
-        state["priority_level"] = priority
-        
+        response = await rag_engine.agenerate_answer_cached(prompt)
+        match = _JSON_BLOCK_RE.search(response)
+        decision = json.loads(match.group(0)) if match else _parse_labelled_decision(response)
+
+        action = str(decision.get("next_action", "")).strip().upper()
+        if action not in _VALID_ACTIONS:
+            action = "MANUAL_REVIEW"
+        state.next_action = action
+        state.decision_reasoning = decision.get("decision_reasoning") or "No reason provided"
+
+        risk_level = str(decision.get("risk_level", "")).strip().upper()
+        if risk_level not in _VALID_RISK_LEVELS:
+            risk_level = "MEDIUM"  # Safe default
+        state.risk_level = risk_level
+        state.risk_analysis = decision.get("risk_analysis") or response
+        state.requires_approval = risk_level in ["MEDIUM", "HIGH"]
+
+        escalate = decision.get("escalate_to_human", False)
+        if isinstance(escalate, str):
+            escalate = escalate.strip().upper() in ("YES", "TRUE")
+        priority = str(decision.get("priority_level", "")).strip().upper()
+        if priority not in _VALID_PRIORITIES:
+            priority = "NORMAL"
+        state.escalate_to_human = bool(escalate)
+        state.escalation_reason = decision.get("escalation_reason") or response
+        state.priority_level = priority
+
     except Exception as e:
-        logger.exception("escalation_decision_node: LLM escalation decision failed, using fallback logic")
-        # Fallback escalation logic
-        should_escalate = (
-            risk_level == "HIGH" or 
-            next_action in ["REJECT", "MANUAL_REVIEW"] or
-            is_duplicate or
-            len(validation.get("issues", [])) > 2
-        )
-        
-        state["escalate_to_human"] = should_escalate
-        state["escalation_reason"] = f"Fallback: Risk={risk_level}, Action={next_action}, Issues={len(validation.get('issues', []))}"
-        state["priority_level"] = "HIGH" if should_escalate else "NORMAL"
-    
-    logger.debug(f"escalation_decision_node: Escalate={state['escalate_to_human']}, Priority={state['priority_level']}")
-    return state
\ No newline at end of file
+        logger.exception("combined_decision_node: LLM decision failed, using fallback logic")
+        _fallback_decision(state)
+        _fallback_risk(state, amount)
+        _fallback_escalation(state)
+
+    logger.debug(
+        f"combined_decision_node: Action={state.next_action}, Risk={state.risk_level}, "
+        f"Escalate={state.escalate_to_human}, Priority={state.priority_level}"
+    )
+    return state
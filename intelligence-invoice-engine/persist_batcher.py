@@ -0,0 +1,91 @@
+# persist_batcher.py
+import asyncio
+import logging
+import weakref
+from typing import List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH = 250      # chunks per embed + Chroma insert
+MAX_WAIT_MS = 100    # longest the first queued chunk waits for the batch to fill
+MAX_PENDING = 64     # invoices allowed to wait on the batcher at once
+
+
+class PersistBatcher:
+    """
+    Collects chunks from concurrent persist_node calls and stores them with
+    one embed + Chroma insert per batch instead of one per invoice.
+    """
+
+    def __init__(self, engine, max_batch: int = MAX_BATCH, max_wait_ms: int = MAX_WAIT_MS, max_pending: int = MAX_PENDING):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._pending: List[Tuple[List[Document], asyncio.Future]] = []
+        self._pending_chunks = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flush_lock = asyncio.Lock()
+        self._slots = asyncio.Semaphore(max_pending)
+        self._flushes: set = set()
+
+    async def add(self, chunks: List[Document]) -> int:
+        """Queues chunks for the next batch; returns how many of them were newly stored"""
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending.append((chunks, future))
+            self._pending_chunks += len(chunks)
+
+            if self._pending_chunks >= self.max_batch:
+                self._start_flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.max_wait, self._start_flush)
+
+            return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        self._pending_chunks = 0
+        task = asyncio.ensure_future(self._flush(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List[Tuple[List[Document], asyncio.Future]]):
+        docs = [doc for chunks, _ in batch for doc in chunks]
+        try:
+            # One insert at a time so the dedup check sees earlier batches
+            async with self._flush_lock:
+                inserted = await asyncio.to_thread(self.engine.add_new_documents, docs)
+        except Exception as e:
+            logger.error(f"PersistBatcher: failed to store {len(docs)} chunks: {str(e)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        logger.debug(f"PersistBatcher: stored {len(inserted)} new chunks for {len(batch)} invoices")
+        inserted_ids = {id(doc) for doc in inserted}
+        for chunks, future in batch:
+            if not future.done():
+                future.set_result(sum(1 for doc in chunks if id(doc) in inserted_ids))
+
+
+# asyncio primitives belong to one event loop, so each loop gets its own batcher
+_batchers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, PersistBatcher]" = weakref.WeakKeyDictionary()
+
+
+def get_persist_batcher(engine) -> PersistBatcher:
+    """Get the batcher for the running event loop, creating it on first use"""
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        batcher = _batchers[loop] = PersistBatcher(engine)
+    return batcher
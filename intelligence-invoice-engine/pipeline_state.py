@@ -0,0 +1,69 @@
+# pipeline_state.py
+from dataclasses import dataclass, field
+from typing import Any, BinaryIO, Dict, List, Optional
+
+from langchain_core.documents import Document
+
+
+@dataclass(slots=True)
+class PipelineState:
+    """
+    State passed between workflow nodes. Each node reads the attributes it
+    expects and sets the ones it produces; defaults match the API response.
+    """
+    # Input (one of these, unless invoice data is given directly)
+    file_bytes: Optional[bytes] = None
+    file_obj: Optional[BinaryIO] = None
+
+    # OCR + validation
+    invoice: Dict[str, Any] = field(default_factory=dict)
+    validation: Dict[str, Any] = field(default_factory=dict)
+
+    # Embedding + retrieval
+    embedding_text: str = ""
+    query_embedding: Optional[tuple] = None
+    chunks: List[Document] = field(default_factory=list)
+    retrieval_results: Optional[List[tuple]] = None
+    similar_invoices: List[Dict[str, Any]] = field(default_factory=list)
+    highest_similarity: float = 0
+    is_duplicate: bool = False
+    duplicate_details: Optional[Dict[str, Any]] = None
+    persisted_chunks: int = 0
+    vector_doc_id: str = ""
+    rag: Dict[str, Any] = field(default_factory=lambda: {"hits": []})
+    synthesis: str = ""
+
+    # Autonomous decisions
+    next_action: str = "APPROVE"
+    decision_reasoning: str = ""
+    risk_level: str = "LOW"
+    risk_analysis: str = ""
+    requires_approval: bool = False
+    escalate_to_human: bool = False
+    escalation_reason: str = ""
+    priority_level: str = "NORMAL"
+
+    # Set by run_pipeline when this invoice failed
+    error: Optional[str] = None
+
+    def to_response(self) -> Dict[str, Any]:
+        """JSON-serializable workflow result returned by the API"""
+        return {
+            "invoice": self.invoice,
+            "validation": self.validation,
+            "persisted_chunks": self.persisted_chunks,
+            "vector_doc_id": self.vector_doc_id,
+            "similar_invoices": self.similar_invoices,
+            "is_duplicate": self.is_duplicate,
+            "duplicate_details": self.duplicate_details,
+            # Autonomous Decision Making Results
+            "next_action": self.next_action,
+            "decision_reasoning": self.decision_reasoning,
+            "risk_level": self.risk_level,
+            "risk_analysis": self.risk_analysis,
+            "requires_approval": self.requires_approval,
+            "escalate_to_human": self.escalate_to_human,
+            "escalation_reason": self.escalation_reason,
+            "priority_level": self.priority_level,
+            "synthesis": self.synthesis
+        }
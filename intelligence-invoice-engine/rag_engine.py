@@ -1,25 +1,123 @@
 import os
+import asyncio
 import hashlib
 import logging
-from typing import List
+import threading
+import weakref
+from typing import Any, BinaryIO, List, Optional, Sequence, Union
+import torch
 from dotenv import load_dotenv
+from cachetools import LRUCache, TTLCache
+from cachetools.keys import hashkey
+from semantic_text_splitter import TextSplitter
 
 from langchain_core.documents import Document
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import Chroma
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 
 # Your working Groq helper
 from langchain.chat_models import init_chat_model
 
+try:
+    from blake3 import blake3
+except ImportError:  # stdlib fallback, same 128-bit digest length
+    blake3 = None
+
 logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Chunk size and overlap in characters
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+# Chunks per forward pass of the embedding model
+EMBED_BATCH_SIZE = 64
+
+# HNSW index settings, applied when the collection is first created.
+# The distance stays Chroma's default squared L2, like stores created before
+# these settings; on normalized vectors it is 2 * (1 - cosine similarity)
+HNSW_METADATA = {
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": 100,
+    "hnsw:num_threads": os.cpu_count(),
+}
+
+LLM_MODEL = "llama-3.1-8b-instant"
+
+ANSWER_PROMPT = ChatPromptTemplate.from_template("""
+Answer ONLY based on the following context:
+
+{context}
+
+Question: {question}
+Answer:
+""")
+
+# Recorded next to each chunk hash so mixed-algorithm collections can be detected
+HASH_ALGO = "blake3" if blake3 is not None else "blake2b"
+
+
+def _embedding_device_and_dtype():
+    """Device and weight dtype for the embedding model (EMBEDDING_DTYPE overrides auto)"""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    name = os.getenv("EMBEDDING_DTYPE", "auto").lower()
+    if name == "auto":
+        if device == "cuda":
+            name = "bfloat16" if torch.cuda.is_bf16_supported() else "float16"
+        else:
+            name = "float32"
+    return device, getattr(torch, name)
+
+
+def _embedding_backend(device: str) -> str:
+    """Inference backend for the embedding model (EMBEDDING_BACKEND overrides auto)"""
+    name = os.getenv("EMBEDDING_BACKEND", "auto").lower()
+    if name == "auto":
+        # ONNX Runtime's fused CPU kernels beat PyTorch eager on CPU
+        name = "torch" if device == "cuda" else "onnx"
+    return name
+
+
+def _upcast_token_embeddings(module, inputs, features):
+    # Pool and normalize in float32; half-precision accumulation loses accuracy
+    features["token_embeddings"] = features["token_embeddings"].float()
+    return features
+
+
+def _new_hasher():
+    return blake3() if blake3 is not None else hashlib.blake2b(digest_size=16)
+
+
+def _hexdigest(hasher) -> str:
+    return hasher.hexdigest(16) if blake3 is not None else hasher.hexdigest()
+
+
+def content_hash(text: str) -> str:
+    """128-bit hex fingerprint of the text, used for dedup and content-derived ids"""
+    hasher = _new_hasher()
+    hasher.update(text.encode("utf-8", "ignore"))
+    return _hexdigest(hasher)
+
+
+def file_hash(source: Union[bytes, memoryview, BinaryIO], block_size: int = 1 << 20) -> str:
+    """content_hash for file contents, given as a buffer or an open binary file (read in blocks, rewound)"""
+    hasher = _new_hasher()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        hasher.update(source)
+    else:
+        source.seek(0)
+        for block in iter(lambda: source.read(block_size), b""):
+            hasher.update(block)
+        source.seek(0)
+    return _hexdigest(hasher)
+
 class RAGEngine:
     """
     Single combined module that performs:
@@ -30,35 +128,71 @@ class RAGEngine:
     - LLM answer generation
     """
 
-    def __init__(self):
-        self.persist_directory = "./chroma_store"
+    def __init__(self, persist_directory: str = "./chroma_store"):
+        self.persist_directory = persist_directory
         self.collection_name = "rag_collection"
 
+        # Rust-backed splitter, built once: prefers paragraph, then sentence,
+        # then word boundaries, like the recursive splitter it replaces
+        self.splitter = TextSplitter(CHUNK_SIZE, overlap=CHUNK_OVERLAP)
+
         # Embedder - Using HuggingFace (free, runs locally)
-        logger.info("Initializing HuggingFace embeddings...")
+        device, dtype = _embedding_device_and_dtype()
+        backend = _embedding_backend(device)
+        if backend == "onnx":
+            dtype = torch.float32  # the exported ONNX graph runs in float32
+            model_kwargs = {"device": device, "backend": "onnx"}
+        else:
+            model_kwargs = {"device": device, "model_kwargs": {"torch_dtype": dtype}}
+        logger.info(f"Initializing HuggingFace embeddings ({device}, {backend}, {dtype})...")
         self.embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2"
+            model_name=EMBEDDING_MODEL,
+            model_kwargs=model_kwargs,
+            encode_kwargs={"batch_size": EMBED_BATCH_SIZE, "normalize_embeddings": True}
         )
+        if dtype != torch.float32:
+            # Half-precision transformer, float32 pooling; stored vectors stay float32
+            self.embeddings.client[0].register_forward_hook(_upcast_token_embeddings)
 
         # Vector DB (persistent)
         self.vector_store = Chroma(
             collection_name=self.collection_name,
             embedding_function=self.embeddings,
-            persist_directory=self.persist_directory
+            persist_directory=self.persist_directory,
+            collection_metadata=HNSW_METADATA
         )
 
+        # Query embeddings keyed by a fingerprint of everything that shapes the
+        # vector (model, dtype, normalization, text); keys stay small for long texts
+        self._embedding_fingerprint = f"{EMBEDDING_MODEL}|{backend}|{dtype}|normalize=True|"
+        self._query_embeddings = LRUCache(maxsize=4096)
+        self._query_embeddings_lock = threading.Lock()
+
+        # LLM client and answer chain, created on first generate call. Async
+        # calls get one chain per event loop: the async HTTP client's
+        # connection pool is bound to the loop it first ran on, and
+        # run_workflow starts a new loop per call
+        self._llm = None
+        self._answer_chain = None
+        self._async_answer_chains: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+
+        # Decision prompts repeat
+        self._context_free_answers = LRUCache(maxsize=1024)
+
+        # Recent similarity search results; cleared whenever the collection changes
+        self._retrieval_cache = TTLCache(maxsize=1024, ttl=300)
+        self._retrieval_cache_lock = threading.Lock()
+
+    def warmup(self):
+        """Runs one embedding so kernel setup / graph optimization happens before the first request"""
+        self.embeddings.embed_query("warmup")
+
     # ----------------------------
     # 1. TEXT SPLITTING
     # ----------------------------
     def split_documents(self, text: str) -> List[Document]:
         logger.info("Splitting text into chunks...")
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len
-        )
-        docs = [Document(page_content=text)]
-        chunks = splitter.split_documents(docs)
+        chunks = [Document(page_content=chunk) for chunk in self.splitter.chunks(text)]
         logger.info(f"Created {len(chunks)} chunks")
         return chunks
 
@@ -66,50 +200,125 @@ class RAGEngine:
     # 2. EMBEDDINGS + DEDUP
     # ----------------------------
     def compute_hash(self, text: str) -> str:
-        return hashlib.md5(text.encode("utf-8")).hexdigest()
+        return content_hash(text)
 
     def embed_documents(self, docs: List[Document]) -> int:
+        return len(self.add_new_documents(docs))
+
+    def add_new_documents(self, docs: List[Document]) -> List[Document]:
+        """Embeds and stores the docs whose content is not stored yet; returns those docs"""
         logger.info("Embedding documents with dedup check...")
 
+        for d in docs:
+            d.metadata["hash"] = self.compute_hash(d.page_content)
+            d.metadata["hash_algo"] = HASH_ALGO
+
+        # Stream through fixed-size batches: each is looked up, embedded and
+        # added before the next, so lookups and vectors stay bounded
+        seen = set()
+        new_docs = []
+        for i in range(0, len(docs), EMBED_BATCH_SIZE):
+            new_docs.extend(self._add_batch(docs[i:i + EMBED_BATCH_SIZE], seen))
+
+        if new_docs:
+            self.vector_store.persist()
+            self.invalidate_retrieval_cache()
+
+        logger.info(f"{len(new_docs)} new documents embedded.")
+        return new_docs
+
+    def existing_hashes(self, hashes: List[str]) -> set:
+        """Which of the hashes are already stored"""
+        # Matching on the hash metadata (rather than ids) also finds chunks
+        # stored before ids were hashes
         try:
-            existing = self.vector_store.get(include=["metadatas"])
-            existing_hashes = {m["hash"] for m in existing["metadatas"] if "hash" in m}
+            existing = self.vector_store._collection.get(
+                where={"hash": {"$in": hashes}},
+                include=["metadatas"]
+            )
+            return {m["hash"] for m in existing["metadatas"] if "hash" in m}
         except:
-            existing_hashes = set()
+            return set()
+
+    def _add_batch(self, batch: List[Document], seen: set) -> List[Document]:
+        """Filters out known chunks, then embeds and adds the rest; returns the added docs"""
+        seen.update(self.existing_hashes(list({d.metadata["hash"] for d in batch})))
 
         new_docs = []
-        for d in docs:
-            h = self.compute_hash(d.page_content)
-            d.metadata["hash"] = h
-            if h not in existing_hashes:
+        for d in batch:
+            h = d.metadata["hash"]
+            if h not in seen:
+                seen.add(h)
                 new_docs.append(d)
             else:
                 logger.info(f"Skipping duplicate chunk: {h}")
+        if not new_docs:
+            return new_docs
 
-        if new_docs:
-            self.vector_store.add_documents(new_docs)
-            self.vector_store.persist()
-
-        logger.info(f"{len(new_docs)} new documents embedded.")
-        return len(new_docs)
+        # Similar lengths together to cut padding; vectors go straight to the collection
+        new_docs.sort(key=lambda d: len(d.page_content))
+        texts = [d.page_content for d in new_docs]
+        self.vector_store._collection.add(
+            ids=[d.metadata["hash"] for d in new_docs],
+            documents=texts,
+            metadatas=[d.metadata for d in new_docs],
+            embeddings=self.embeddings.embed_documents(texts)
+        )
+        return new_docs
 
     # ----------------------------
     # 3. RETRIEVAL
     # ----------------------------
-    def retrieve(self, query: str) -> List[Document]:
+    def find_by_metadata(self, where: dict, limit: int = 5) -> List[Document]:
+        """Metadata-only lookup (no embedding, no vector search)"""
+        results = self.vector_store.get(where=where, limit=limit, include=["documents", "metadatas"])
+        return [
+            Document(page_content=doc, metadata=metadata or {})
+            for doc, metadata in zip(results["documents"], results["metadatas"])
+        ]
+
+    def embed_query_cached(self, text: str) -> tuple:
+        """Query embedding, memoized per fingerprint of model settings + text"""
+        key = content_hash(self._embedding_fingerprint + text)
+        with self._query_embeddings_lock:
+            vector = self._query_embeddings.get(key)
+        if vector is None:
+            vector = tuple(self.embeddings.embed_query(text))
+            with self._query_embeddings_lock:
+                self._query_embeddings[key] = vector
+        return vector
+
+    def retrieve(self, query: str, embedding: Optional[Sequence[float]] = None) -> List[Document]:
         logger.info(f"Retrieving for query: {query}")
-        retriever = self.vector_store.as_retriever(search_kwargs={"k": 3})
-        return retriever.invoke(query)
+        if embedding is None:
+            embedding = self.embed_query_cached(query)
+        return self.vector_store.similarity_search_by_vector(list(embedding), k=3)
     
-    def retrieve_with_scores(self, query: str, top_k: int = 5) -> List[tuple]:
+    def retrieve_with_scores(self, query: str, top_k: int = 5, embedding: Optional[Sequence[float]] = None) -> List[tuple]:
         """Retrieve documents with similarity scores for duplicate detection"""
+        key = hashkey(query, top_k)
+        with self._retrieval_cache_lock:
+            cached = self._retrieval_cache.get(key)
+        if cached is not None:
+            logger.info(f"Retrieval cache hit for query: {query}")
+            return cached
+
         logger.info(f"Retrieving with scores for query: {query}")
-        results = self.vector_store.similarity_search_with_score(query, k=top_k)
+        if embedding is None:
+            embedding = self.embed_query_cached(query)
+        results = self.vector_store.similarity_search_by_vector_with_relevance_scores(list(embedding), k=top_k)
+        with self._retrieval_cache_lock:
+            self._retrieval_cache[key] = results
         return results
+
+    def invalidate_retrieval_cache(self):
+        """New or removed documents can change any search result"""
+        with self._retrieval_cache_lock:
+            self._retrieval_cache.clear()
     
-    def build_rag_context(self, query: str, top_k: int = 5) -> dict:
+    def build_rag_context(self, query: str, top_k: int = 5, embedding: Optional[Sequence[float]] = None) -> dict:
         logger.info(f"Building RAG context for query: {query}")
-        docs = self.retrieve(query)
+        docs = self.retrieve(query, embedding)
         return {
             "hits": [{
                 "content": d.page_content,
@@ -124,29 +333,43 @@ class RAGEngine:
     def docs_to_context(self, docs: List[Document]) -> str:
         return "\n\n".join(d.page_content for d in docs)
 
-    def generate_answer(self, query: str, docs: List[Document]) -> str:
-        llm = init_chat_model("llama-3.1-8b-instant", model_provider="groq")
+    @property
+    def llm(self):
+        """Groq chat model for the synchronous methods, created on first use and then reused"""
+        if self._llm is None:
+            self._llm = init_chat_model(LLM_MODEL, model_provider="groq")
+        return self._llm
 
-        prompt = ChatPromptTemplate.from_template("""
-Answer ONLY based on the following context:
+    @property
+    def answer_chain(self):
+        """Prompt | LLM | parser chain for the synchronous methods, built once; takes {"context", "question"}"""
+        if self._answer_chain is None:
+            self._answer_chain = ANSWER_PROMPT | self.llm | StrOutputParser()
+        return self._answer_chain
 
-{context}
+    def _async_answer_chain(self):
+        """answer_chain for async calls on the running event loop, with its own chat model"""
+        loop = asyncio.get_running_loop()
+        chain = self._async_answer_chains.get(loop)
+        if chain is None:
+            llm = init_chat_model(LLM_MODEL, model_provider="groq")
+            chain = self._async_answer_chains[loop] = ANSWER_PROMPT | llm | StrOutputParser()
+        return chain
 
-Question: {question}
-Answer:
-""")
+    def generate_answer(self, query: str, docs: List[Document]) -> str:
+        return self.answer_chain.invoke({"context": self.docs_to_context(docs), "question": query})
 
-        chain = (
-            {
-                "context": lambda _: self.docs_to_context(docs),
-                "question": RunnablePassthrough(),
-            }
-            | prompt
-            | llm
-            | StrOutputParser()
-        )
+    async def agenerate_answer(self, query: str, docs: List[Document]) -> str:
+        """Async generate_answer; awaits the LLM without holding a worker thread"""
+        return await self._async_answer_chain().ainvoke({"context": self.docs_to_context(docs), "question": query})
 
-        return chain.invoke(query)
+    async def agenerate_answer_cached(self, query: str) -> str:
+        """Context-free agenerate_answer memoized by prompt text (decision prompts repeat)"""
+        answer = self._context_free_answers.get(query)
+        if answer is None:
+            answer = await self.agenerate_answer(query, [])
+            self._context_free_answers[query] = answer
+        return answer
     
     # ----------------------------
     # 5. DATABASE MANAGEMENT
@@ -175,6 +398,7 @@ Answer:
             collection = self.vector_store._collection
             count_before = collection.count()
             collection.delete()
+            self.invalidate_retrieval_cache()
             return {
                 "status": "success",
                 "message": "Vector database cleared",
@@ -216,6 +440,7 @@ Answer:
         try:
             collection = self.vector_store._collection
             collection.delete(ids=[invoice_id])
+            self.invalidate_retrieval_cache()
             return {
                 "status": "success",
                 "message": f"Invoice {invoice_id} deleted"
@@ -225,3 +450,17 @@ Answer:
                 "status": "error",
                 "message": f"Failed to delete invoice: {str(e)}"
             }
+
+
+_rag_engine: Optional[RAGEngine] = None
+_rag_engine_lock = threading.Lock()
+
+
+def get_rag_engine() -> RAGEngine:
+    """Process-wide RAGEngine, created on first call; loads the model and store only once"""
+    global _rag_engine
+    if _rag_engine is None:
+        with _rag_engine_lock:
+            if _rag_engine is None:
+                _rag_engine = RAGEngine()
+    return _rag_engine
@@ -0,0 +1,45 @@
+"""
+Extraction regression tests: results must match the original pandas-based extractor
+"""
+import openpyxl
+from extract_invoice import extract_invoice_from_excel_rows
+
+
+def _xlsx_bytes(tmp_path, cells):
+    """Writes {(row, col): value} to a one-sheet workbook and returns its bytes"""
+    wb = openpyxl.Workbook()
+    for (row, col), value in cells.items():
+        wb.active.cell(row=row, column=col, value=value)
+    path = tmp_path / "invoice.xlsx"
+    wb.save(path)
+    return path.read_bytes()
+
+
+def test_raw_text_covers_rows_after_the_field_window(tmp_path):
+    headers = ["Invoice Number", "Vendor", "Vendor Code", "Service", "Date", "Total Amount"]
+    cells = {(1, col): header for col, header in enumerate(headers, 1)}
+    cells.update({(2, col): value for col, value in enumerate(["INV-77", "Acme", "V7", "Audit", "2024-05-06", "900.00"], 1)})
+    for i in range(120):
+        cells[(3 + i, 1)] = f"line {i}"
+
+    invoice = extract_invoice_from_excel_rows(_xlsx_bytes(tmp_path, cells))
+
+    assert invoice["invoice_number"] == "INV-77"
+    assert invoice["raw_text"].splitlines()[-1] == "line 119"
+    assert len(invoice["raw_text"].splitlines()) == 121
+
+
+def test_blank_first_row_stays_the_header_row(tmp_path):
+    # pandas used the (blank) first row as the header, so the real header
+    # row is data: expected values are the old extractor's output
+    cells = {
+        (2, 1): "Invoice Number", (2, 2): "Vendor", (2, 3): "Total Amount",
+        (3, 1): "INV-88", (3, 2): "Beta", (3, 3): "12.00",
+    }
+
+    invoice = extract_invoice_from_excel_rows(_xlsx_bytes(tmp_path, cells))
+
+    assert invoice["invoice_number"] == "Invoice"
+    assert invoice["vendor"] is None
+    assert invoice["total_amount"] == "12.00"
+    assert invoice["raw_text"] == "Invoice Number Vendor Total Amount\nINV-88 Beta 12.00\n"
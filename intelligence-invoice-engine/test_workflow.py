@@ -1,8 +1,17 @@
 """
 Test script to demonstrate the complete workflow step by step
 """
+import argparse
+import asyncio
+import functools
+import io
+import json
 import logging
-from workflow import run_workflow
+import sys
+from pathlib import Path
+import nodes
+from workflow import run_pipeline, run_workflow
+from rag_engine import RAGEngine
 
 # Configure detailed logging
 logging.basicConfig(
@@ -10,79 +19,131 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-def test_workflow_with_sample():
-    print("\n" + "="*80)
-    print("INVOICE AI PROCESSOR - WORKFLOW DEMONSTRATION")
-    print("="*80 + "\n")
+SAMPLE_INVOICE = Path(__file__).parent / "sample_invoice.xlsx"
+
+def test_run_pipeline_flags_repeat_within_batch(tmp_path, monkeypatch):
+    """The second copy of an invoice in one batch is caught even though workers run concurrently"""
+    monkeypatch.setattr(nodes, "rag_engine", RAGEngine(persist_directory=str(tmp_path)))
+    sample = SAMPLE_INVOICE.read_bytes()
+
+    first, second, broken = asyncio.run(run_pipeline([sample, sample, b"not a workbook"]))
+
+    assert not first.is_duplicate and first.persisted_chunks > 0
+    assert second.is_duplicate and second.persisted_chunks == 0
+    assert broken.error
+    assert broken.next_action == "MANUAL_REVIEW" and broken.escalate_to_human
+
+def test_prefilter_leaves_reissued_number_to_similarity(tmp_path, monkeypatch):
+    """A stored invoice number with new content is not a duplicate by number alone"""
+    monkeypatch.setattr(nodes, "rag_engine", RAGEngine(persist_directory=str(tmp_path)))
+    original = {"invoice_number": "INV-7", "vendor": "Acme", "total_amount": "120.00",
+                "raw_text": "INV-7 Acme consulting March 120.00"}
+    reissue = {**original, "total_amount": "95.00",
+               "raw_text": "INV-7 Acme corrected hardware order for April, credit applied 95.00"}
+
+    stored, again, corrected = asyncio.run(run_pipeline([original])) + asyncio.run(run_pipeline([original, reissue]))
+
+    assert not stored.is_duplicate
+    assert again.is_duplicate and again.duplicate_details["matched_on"] == "content_hash"
+    assert not corrected.is_duplicate and corrected.persisted_chunks > 0
+    for state in (again, corrected):
+        assert all(isinstance(inv["similarity_score"], float) for inv in state.similar_invoices)
+
+def test_workflow_with_sample(as_json: bool = False):
+    if not as_json:
+        print("\n" + "="*80)
+        print("INVOICE AI PROCESSOR - WORKFLOW DEMONSTRATION")
+        print("="*80 + "\n")
     
     # Read sample invoice
     with open("sample_invoice.xlsx", "rb") as f:
         file_bytes = f.read()
+    file_size = len(file_bytes)
     
-    print("📄 Step 1: File loaded - sample_invoice.xlsx")
-    print(f"   File size: {len(file_bytes)} bytes\n")
+    if not as_json:
+        print("📄 Step 1: File loaded - sample_invoice.xlsx")
+        print(f"   File size: {file_size} bytes\n")
+        print("🚀 Starting workflow...\n")
     
     # Run workflow
-    print("🚀 Starting workflow...\n")
     result = run_workflow(file_bytes)
     
+    # One machine-readable record for CI / benchmarks
+    if as_json:
+        record = result.to_response()
+        record["file_size"] = file_size
+        record["chunks"] = len(result.chunks)
+        record["rag_hits"] = len(result.rag.get("hits", []))
+        sys.stdout.write(json.dumps(record, default=str) + "\n")
+        return
+    
+    # Build the report in memory and write it once, so output does not
+    # interleave with (or slow down) the workflow's own logging
+    buf = io.StringIO()
+    out = functools.partial(print, file=buf)
+    
     # Display results step by step
-    print("\n" + "="*80)
-    print("WORKFLOW RESULTS")
-    print("="*80 + "\n")
+    out("\n" + "="*80)
+    out("WORKFLOW RESULTS")
+    out("="*80 + "\n")
     
-    print("📋 Step 2: OCR - Invoice Extraction")
-    print("-" * 40)
-    invoice = result.get("invoice", {})
-    print(f"   Invoice Number: {invoice.get('invoice_number')}")
-    print(f"   Vendor: {invoice.get('vendor')}")
-    print(f"   Vendor Code: {invoice.get('vendor_code')}")
-    print(f"   Service: {invoice.get('service')}")
-    print(f"   Date: {invoice.get('date')}")
-    print(f"   Total Amount: {invoice.get('total_amount')}")
-    print()
+    out("📋 Step 2: OCR - Invoice Extraction")
+    out("-" * 40)
+    invoice = result.invoice
+    out(f"   Invoice Number: {invoice.get('invoice_number')}")
+    out(f"   Vendor: {invoice.get('vendor')}")
+    out(f"   Vendor Code: {invoice.get('vendor_code')}")
+    out(f"   Service: {invoice.get('service')}")
+    out(f"   Date: {invoice.get('date')}")
+    out(f"   Total Amount: {invoice.get('total_amount')}")
+    out()
     
-    print("✅ Step 3: Validation")
-    print("-" * 40)
-    validation = result.get("validation", {})
-    print(f"   Overall OK: {validation.get('overall_ok')}")
-    print(f"   Issues: {validation.get('issues', [])}")
-    print()
+    out("✅ Step 3: Validation")
+    out("-" * 40)
+    validation = result.validation
+    out(f"   Overall OK: {validation.get('overall_ok')}")
+    out(f"   Issues: {validation.get('issues', [])}")
+    out()
     
-    print("📦 Step 4: Embedding")
-    print("-" * 40)
-    chunks = result.get("chunks", [])
-    print(f"   Text chunks created: {len(chunks)}")
-    print()
+    out("📦 Step 4: Embedding")
+    out("-" * 40)
+    chunks = result.chunks
+    out(f"   Text chunks created: {len(chunks)}")
+    out()
     
-    print("💾 Step 5: Persistence")
-    print("-" * 40)
-    print(f"   New chunks stored: {result.get('persisted_chunks', 0)}")
-    print(f"   Document ID: {result.get('vector_doc_id')}")
-    print()
+    out("💾 Step 5: Persistence")
+    out("-" * 40)
+    out(f"   New chunks stored: {result.persisted_chunks}")
+    out(f"   Document ID: {result.vector_doc_id}")
+    out()
     
-    print("🔍 Step 6: Similarity Search")
-    print("-" * 40)
-    similar = result.get("similar", [])
-    print(f"   Similar documents found: {len(similar)}")
-    print()
+    out("🔍 Step 6: Similarity Search")
+    out("-" * 40)
+    similar = result.similar_invoices
+    out(f"   Similar documents found: {len(similar)}")
+    out()
     
-    print("🧠 Step 7: RAG Context")
-    print("-" * 40)
-    rag = result.get("rag", {})
+    out("🧠 Step 7: RAG Context")
+    out("-" * 40)
+    rag = result.rag
     hits = rag.get("hits", [])
-    print(f"   Context hits retrieved: {len(hits)}")
-    print()
+    out(f"   Context hits retrieved: {len(hits)}")
+    out()
+    
+    out("✨ Step 8: AI Synthesis")
+    out("-" * 40)
+    synthesis = result.synthesis
+    out(f"   {synthesis}")
+    out()
     
-    print("✨ Step 8: AI Synthesis")
-    print("-" * 40)
-    synthesis = result.get("synthesis", "")
-    print(f"   {synthesis}")
-    print()
+    out("="*80)
+    out("WORKFLOW COMPLETED SUCCESSFULLY")
+    out("="*80)
     
-    print("="*80)
-    print("WORKFLOW COMPLETED SUCCESSFULLY")
-    print("="*80)
+    sys.stdout.write(buf.getvalue())
 
 if __name__ == "__main__":
-    test_workflow_with_sample()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--json", action="store_true", help="print one JSON record instead of the report")
+    args = parser.parse_args()
+    test_workflow_with_sample(as_json=args.json)
@@ -3,39 +3,30 @@ from typing import Dict, Any
 
 logger = logging.getLogger(__name__)
 
+# Required fields and the issue reported when one is missing or empty
+_REQUIRED_FIELDS = (
+    ("invoice_number", "Missing invoice number"),
+    ("vendor", "Missing vendor"),
+    ("vendor_code", "Missing vendor code"),
+    ("service", "Missing service"),
+    ("date", "Missing date"),
+    ("total_amount", "Missing total amount"),
+)
+_FIELDS_VALIDATED = [field for field, _ in _REQUIRED_FIELDS]
+
 def run_all_validations(invoice: Dict[str, Any]) -> Dict[str, Any]:
     """
     Validates invoice fields and returns validation results.
     """
     logger.info("Running invoice validations")
     
-    issues = []
-    
     # Check required fields
-    if not invoice.get("invoice_number"):
-        issues.append("Missing invoice number")
-    
-    if not invoice.get("vendor"):
-        issues.append("Missing vendor")
-    
-    if not invoice.get("vendor_code"):
-        issues.append("Missing vendor code")
-    
-    if not invoice.get("service"):
-        issues.append("Missing service")
-    
-    if not invoice.get("date"):
-        issues.append("Missing date")
-    
-    if not invoice.get("total_amount"):
-        issues.append("Missing total amount")
-    
-    overall_ok = len(issues) == 0
+    issues = [message for field, message in _REQUIRED_FIELDS if not invoice.get(field)]
     
     validation_result = {
-        "overall_ok": overall_ok,
+        "overall_ok": not issues,
         "issues": issues,
-        "fields_validated": ["invoice_number", "vendor", "vendor_code", "service", "date", "total_amount"]
+        "fields_validated": list(_FIELDS_VALIDATED)
     }
     
     logger.info(f"Validation result: {validation_result}")
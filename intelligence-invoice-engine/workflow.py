@@ -1,42 +1,191 @@
 # workflow.py
-from typing import Dict, Any, Union
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from typing import BinaryIO, Iterable, List, Optional, Union
 from nodes import (
     ocr_node,
     validate_node,
+    prefilter_node,
     embed_node,
     persist_node,
     similar_node,
     rag_node,
     synth_node,
-    decision_node,
-    risk_assessment_node,
-    escalation_decision_node,
+    combined_decision_node,
 )
+from cachetools import LRUCache
 from extract_invoice import InvoiceData
+from rag_engine import content_hash, file_hash
+from pipeline_state import PipelineState
+
+logger = logging.getLogger(__name__)
+
+# run_pipeline: extracted invoices waiting for downstream nodes, and how
+# many invoices go through the downstream nodes at once
+PIPELINE_QUEUE_SIZE = 4
+PIPELINE_WORKERS = 4
+
+# Extracted invoice fields by file fingerprint. Only OCR output is cached:
+# everything downstream depends on what is already stored (duplicates)
+OCR_CACHE_SIZE = 256
+_ocr_cache = LRUCache(maxsize=OCR_CACHE_SIZE)
+
+
+async def _embed_and_search(state: PipelineState) -> PipelineState:
+    state = await prefilter_node(state)
+    if state.is_duplicate:
+        return state  # same content already stored: no embedding or vector search needed
+    state = await embed_node(state)
+    return await similar_node(state)
+
+
+async def _persist_and_synthesize(state: PipelineState) -> PipelineState:
+    # Synthesis only needs the RAG context, so it does not wait for the batched
+    # write; the write is still finished before the state is returned
+    persist = asyncio.create_task(persist_node(state))
+    try:
+        if not state.is_duplicate:  # duplicates are reported without RAG context
+            await rag_node(state)
+        await synth_node(state)
+    finally:
+        await persist
+    return state
+
+
+async def _ocr(input_data: Union[bytes, BinaryIO, dict, InvoiceData]) -> PipelineState:
+    """Builds the initial state, running OCR unless invoice data was given directly"""
+    if isinstance(input_data, (dict, InvoiceData)):
+        # InvoiceData provided directly (skip OCR)
+        invoice_dict = input_data.model_dump() if isinstance(input_data, InvoiceData) else input_data
+        return PipelineState(invoice=invoice_dict)
+
+    # Retried uploads of the same file reuse the extracted fields
+    fingerprint = await asyncio.to_thread(file_hash, input_data)
+    invoice = _ocr_cache.get(fingerprint)
+    if invoice is not None:
+        logger.info(f"OCR cache hit for file {fingerprint}")
+        return PipelineState(invoice=dict(invoice))
 
-def run_workflow(input_data: Union[bytes, dict, InvoiceData]) -> Dict[str, Any]:
-    """
-    Autonomous Agent Workflow: OCR → Validate → Embed → Similar → Decision → Risk Assessment → Persist → RAG → Synthesis → Escalation
-    Accepts either file bytes or InvoiceData (dict or model)
-    """
-    # Determine starting point based on input type
     if isinstance(input_data, bytes):
-        state: Dict[str, Any] = {"file_bytes": input_data}
-        state = ocr_node(state)  # Extract invoice data from file
+        state = await ocr_node(PipelineState(file_bytes=input_data))  # Extract invoice data from file
     else:
-        # InvoiceData provided directly (skip OCR)
-        invoice_dict = input_data.dict() if isinstance(input_data, InvoiceData) else input_data
-        state: Dict[str, Any] = {"invoice": invoice_dict}
-
-    # Execute remaining nodes sequentially
-    state = validate_node(state)
-    state = embed_node(state)
-    state = similar_node(state)
-    state = decision_node(state)
-    state = risk_assessment_node(state)
-    state = persist_node(state)
-    state = rag_node(state)
-    state = synth_node(state)
-    state = escalation_decision_node(state)
+        state = await ocr_node(PipelineState(file_obj=input_data))  # Extract invoice data from the open file
+    _ocr_cache[fingerprint] = dict(state.invoice)
+    return state
+
+
+def _mark_failed(state: PipelineState, error: Exception) -> PipelineState:
+    """Records the error and routes the invoice to a human; a failed invoice never reads as approved"""
+    state.error = str(error)
+    state.next_action = "MANUAL_REVIEW"
+    state.decision_reasoning = f"Processing failed: {error}"
+    state.requires_approval = True
+    state.escalate_to_human = True
+    state.escalation_reason = f"Processing failed: {error}"
+    state.priority_level = "HIGH"
+    return state
+
+
+def _serial_keys(state: PipelineState) -> List[str]:
+    """
+    run_pipeline processes invoices sharing a key one after another, so the later
+    one's duplicate checks see what the earlier one stored: same content, or same
+    invoice number and vendor
+    """
+    invoice = state.invoice
+    keys = [f"content:{content_hash(json.dumps(invoice, sort_keys=True, default=str))}"]
+    if invoice.get("invoice_number"):
+        keys.append(f"number:{invoice['invoice_number']}|{invoice.get('vendor') or ''}")
+    return sorted(keys)  # fixed acquisition order, so two workers cannot deadlock
+
+
+async def _process(state: PipelineState) -> PipelineState:
+    """Runs every node after OCR"""
+    # Validation is pure Python and overlaps with embedding + vector search
+    await asyncio.gather(validate_node(state), _embed_and_search(state))
+
+    # The decision only needs validation + similarity results, so its LLM
+    # call overlaps with persisting and the RAG synthesis
+    await asyncio.gather(
+        combined_decision_node(state),
+        _persist_and_synthesize(state),
+    )
 
     return state
+
+
+async def arun_workflow(input_data: Union[bytes, BinaryIO, dict, InvoiceData]) -> PipelineState:
+    """
+    Autonomous Agent Workflow: OCR → (Validate ‖ Prefilter → Embed → Similar) → (Decision/Risk/Escalation ‖ (Persist ‖ RAG) → Synthesis)
+    Accepts file bytes, an open binary file, or InvoiceData (dict or model)
+    Independent nodes run concurrently; each sets its own attributes of the shared state.
+    """
+    state = await _ocr(input_data)
+    return await _process(state)
+
+
+async def run_pipeline(
+    inputs: Iterable[Union[bytes, BinaryIO, dict, InvoiceData]],
+    workers: int = PIPELINE_WORKERS,
+) -> List[PipelineState]:
+    """
+    Runs the workflow over many invoices as a producer/consumer pipeline:
+    OCR of the next invoice overlaps with embedding, retrieval and LLM calls
+    for the ones already extracted. A bounded queue applies backpressure.
+    Returns one state per input, in input order; a failed invoice has state.error set
+    and is sent to MANUAL_REVIEW with escalation.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    results: List[Optional[PipelineState]] = []
+    # Concurrent workers would all run their duplicate checks before any of
+    # them stores its chunks, so repeats within a batch go one at a time
+    locks = defaultdict(asyncio.Lock)
+
+    async def process_in_turn(state: PipelineState) -> PipelineState:
+        keys = _serial_keys(state)
+        for key in keys:
+            await locks[key].acquire()
+        try:
+            return await _process(state)
+        finally:
+            for key in keys:
+                locks[key].release()
+
+    async def consume():
+        while True:
+            index, state = await queue.get()
+            try:
+                results[index] = await process_in_turn(state)
+            except Exception as e:
+                logger.exception(f"run_pipeline: invoice {index} failed")
+                results[index] = _mark_failed(state, e)
+            finally:
+                queue.task_done()
+
+    consumers = [asyncio.create_task(consume()) for _ in range(workers)]
+    try:
+        for index, input_data in enumerate(inputs):
+            results.append(None)
+            try:
+                state = await _ocr(input_data)
+            except Exception as e:
+                logger.exception(f"run_pipeline: OCR failed for invoice {index}")
+                results[index] = _mark_failed(PipelineState(), e)
+                continue
+            await queue.put((index, state))
+        await queue.join()
+    finally:
+        for consumer in consumers:
+            consumer.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
+
+    return results
+
+
+def run_workflow(input_data: Union[bytes, BinaryIO, dict, InvoiceData]) -> PipelineState:
+    """
+    Synchronous entry point for scripts; runs arun_workflow on a new event loop.
+    """
+    return asyncio.run(arun_workflow(input_data))